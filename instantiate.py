@@ -2,23 +2,28 @@
 # ===========
 # A simple script for instantiating projects from a template.
 
-from collections import deque
 import argparse
+import concurrent.futures
 import fnmatch
+import functools
+import hashlib
 import os
 import pathlib
+import re
 import shutil
+import stat
+import tempfile
+import threading
 import typing
 
 import jinja2
 import yaml
 
-
-def _starts_with_k_digits(s, k):
-    """Returns True iff s starts with k numbers."""
-    if len(s) < k:
-        return False
-    return all(s[i].isdigit() for i in range(k))
+# use libyaml's loader when pyyaml was built with it
+try:
+    from yaml import CSafeLoader as _YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as _YAMLLoader
 
 
 def infer_next_project_number(path, k=2):
@@ -43,32 +48,255 @@ def infer_next_project_number(path, k=2):
     if k is None:
         return None
 
-    path = pathlib.Path(path)
-    directories = (x for x in path.iterdir() if x.is_dir())
-    numbered_directories = (d for d in directories if _starts_with_k_digits(d.name, k))
-    numbers = [int(d.name[:k]) for d in numbered_directories]
-
-    if not numbers:
-        number = 1
-    else:
-        number = max(numbers) + 1
+    with os.scandir(path) as entries:
+        # directory names must start with k digits
+        number = (
+            max(
+                (
+                    int(e.name[:k])
+                    for e in entries
+                    if e.is_dir() and len(e.name) >= k and e.name[:k].isdigit()
+                ),
+                default=0,
+            )
+            + 1
+        )
 
     return format(number, "0" + str(k))
 
 
-def render(src, dst, variables):
-    """Renders the template at src, writes result to dst."""
-    with src.open("r") as fileobj:
-        # raise on undefined variables
-        template = jinja2.Template(fileobj.read(), undefined=jinja2.StrictUndefined)
-    with dst.open("w") as fileobj:
+# large enough that a typical rendered file is written in a single syscall
+_WRITE_BUFFER_SIZE = 1 << 17
+
+# shared by every render so that its options are configured in one place;
+# raise on undefined variables
+_ENVIRONMENT = jinja2.Environment(undefined=jinja2.StrictUndefined)
+
+
+def _default_cache_dir():
+    """Returns the directory in which compiled templates are cached."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return pathlib.Path(cache_home) / "instantiate"
+
+
+def _bytecode_cache(directory):
+    """Returns a bytecode cache keeping compiled templates in directory."""
+    directory.mkdir(parents=True, exist_ok=True)
+    return jinja2.FileSystemBytecodeCache(str(directory))
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(source, bytecode_cache=None):
+    """Compiles the template source, reusing the result for identical sources.
+
+    If bytecode_cache is given, the compiled code is looked up in and stored
+    to it, so that later processes can skip compiling the same source.
+
+    """
+    if bytecode_cache is None:
+        return _ENVIRONMENT.from_string(source)
+
+    # Jinja2 only consults the bytecode cache for templates loaded by name, so
+    # we use it directly here with entries named after the source's hash
+    name = hashlib.blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+    bucket = bytecode_cache.get_bucket(_ENVIRONMENT, name, None, source)
+    if bucket.code is None:
+        bucket.code = _ENVIRONMENT.compile(source)
         try:
-            fileobj.write(template.render(**variables))
-        except Exception as exc:
-            raise RuntimeError(f"Problem rendering {src}: {exc}")
+            bytecode_cache.set_bucket(bucket)
+        except OSError:
+            # the cache is only an optimization
+            pass
+
+    return _ENVIRONMENT.template_class.from_code(
+        _ENVIRONMENT, bucket.code, _ENVIRONMENT.make_globals(None), None
+    )
+
+
+def _has_template_syntax(source):
+    """Returns True iff source contains any Jinja2 delimiters."""
+    return "{{" in source or "{%" in source or "{#" in source
+
+
+def _fsync_directory(path):
+    """Flushes the directory entries of path to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _bind_render(variables, cache=None, durable=False, bytecode_cache=None):
+    """Returns a function of (src, dst) rendering templates with variables.
+
+    Everything that is the same for every file is bound here once, rather than
+    being looked up again on each call. If cache is a dict, it records where
+    each distinct template (by a hash of its contents) was first rendered to,
+    so that identical templates are rendered once and afterwards copied from
+    that file; it must only ever be used with the same variables. If durable
+    is True, each file is flushed to disk before it is moved into place.
+    Compiled templates are kept in bytecode_cache, if it is given.
+
+    """
+    compile_template = _compile
+    has_template_syntax = _has_template_syntax
+    blake2b = hashlib.blake2b
+    buffer_size = _WRITE_BUFFER_SIZE
+    cache_lock = threading.Lock()
+
+    def do_render(src, dst):
+        src, dst = os.fspath(src), os.fspath(dst)
+        with open(src, "rb") as fileobj:
+            source_bytes = fileobj.read()
+        source = source_bytes.decode("utf-8")
+
+        # rendering a file without any delimiters reproduces it, so there is
+        # no need to compile it or to rewrite it
+        if not has_template_syntax(source):
+            if src != dst:
+                shutil.copy(src, dst)
+            return
+
+        # write through a symlink at dst to the file it points to, rather than
+        # replacing the link itself
+        if os.path.islink(dst):
+            dst = os.path.realpath(dst)
+
+        # the first file with these contents is rendered; the others wait for
+        # it to finish and copy its output. each entry is [done, path], where
+        # path is left as None if the first render failed, in which case the
+        # others render for themselves
+        entry = rendered_path = None
+        if cache is not None:
+            key = blake2b(source_bytes, digest_size=16).digest()
+            with cache_lock:
+                first = cache.get(key)
+                if first is None:
+                    cache[key] = entry = [threading.Event(), None]
+            if first is not None:
+                first[0].wait()
+                rendered_path = first[1]
+
+        # render into a temporary file beside dst and move it into place once
+        # complete, so a failure never leaves dst half written and a hard link
+        # at dst is replaced rather than written through
+        directory, name = os.path.split(dst)
+        directory = directory or os.curdir
+        try:
+            mode = stat.S_IMODE(os.stat(dst if os.path.exists(dst) else src).st_mode)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+            try:
+                if rendered_path is not None:
+                    # copy the bytes as they are, without decoding them again
+                    with open(fd, "wb", buffering=buffer_size) as fileobj:
+                        with open(rendered_path, "rb") as rendered:
+                            shutil.copyfileobj(rendered, fileobj, buffer_size)
+                        if durable:
+                            fileobj.flush()
+                            os.fsync(fileobj.fileno())
+                else:
+                    with open(
+                        fd, "w", encoding="utf-8", buffering=buffer_size
+                    ) as fileobj:
+                        template = compile_template(source, bytecode_cache)
+                        try:
+                            # stream into the file rather than building the
+                            # whole output first
+                            template.stream(**variables).dump(fileobj)
+                        except Exception as exc:
+                            raise RuntimeError(f"Problem rendering {src}: {exc}")
+                        if durable:
+                            fileobj.flush()
+                            os.fsync(fileobj.fileno())
+
+                os.chmod(tmp, mode)
+                os.replace(tmp, dst)
+                if entry is not None:
+                    entry[1] = dst
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        finally:
+            # however this ends, don't leave duplicates waiting for it
+            if entry is not None:
+                entry[0].set()
+
+        if durable:
+            _fsync_directory(directory)
+
+    return do_render
+
+
+def render(src, dst, variables):
+    """Renders the template at src, writes result to dst.
+
+    src and dst may be strings or pathlib.Path objects.
+
+    """
+    _bind_render(variables)(src, dst)
+
+
+def _prepare_render(render_function, variables, durable=False, bytecode_cache=None):
+    """Returns a function of (src, dst) calling render_function with variables.
+
+    Also returns whether that function may be called from several threads at
+    once, which is only known to be true of the default render.
+
+    """
+    # the default render is swapped for one bound to these variables, which
+    # also shares output between identical files and works on plain strings;
+    # a custom render function keeps its (src, dst, variables) signature and
+    # is given pathlib.Path objects
+    if render_function is render:
+        bound = _bind_render(
+            variables, cache={}, durable=durable, bytecode_cache=bytecode_cache
+        )
+        return bound, True
+
+    def render_paths(src, dst):
+        render_function(
+            src=pathlib.Path(src), dst=pathlib.Path(dst), variables=variables
+        )
+
+    return render_paths, False
+
+
+def _skip_filter(no_replace):
+    """Returns a function giving the set of names matching any of the patterns."""
+    # translate the patterns once into a single regex instead of matching
+    # every name against every pattern
+    if not no_replace:
+        return lambda names: set()
+
+    pattern = re.compile("|".join(fnmatch.translate(p) for p in no_replace))
+
+    def _skipped_names(names):
+        return set(filter(pattern.match, names))
+
+    return _skipped_names
 
 
-def replace(directory, variables, no_replace=None, render=render):
+def _render_pool():
+    """Creates the thread pool on which files are rendered."""
+    # files are independent of one another, so they are rendered on a pool of
+    # threads while the directory walk continues on the calling thread
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(32, (os.cpu_count() or 4) * 2)
+    )
+
+
+def _link_or_copy(src, dst):
+    """Hard links src to dst, copying it instead if it cannot be linked."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def replace(directory, variables, no_replace=None, render=render, durable=False):
     """Make Jinja2 substitutions in-place in all files under a directory.
 
     Parameters
@@ -83,27 +311,119 @@ def replace(directory, variables, no_replace=None, render=render):
         A collection of fnmatch-style patterns of filenames on which
         replacement should not be performed. If None, replacement will be 
         performed on all files.
+    render : Callable
+        The function called as ``render(src=..., dst=..., variables=...)`` to
+        render each file. When left as the default, a version of it with the
+        variables bound once, sharing output between identical files, is used,
+        and files are rendered concurrently on a pool of threads. A custom
+        render is called on the calling thread, one file at a time.
+    durable : bool
+        Whether to flush each rendered file to disk before moving it into
+        place. Only applies to the default ``render``.
 
     """
-    if no_replace is None:
-        no_replace = []
+    _copy_and_render(
+        directory,
+        directory,
+        variables,
+        no_replace=no_replace,
+        render=render,
+        durable=durable,
+    )
+
+
+def _copy_and_render(
+    src_dir,
+    dst_dir,
+    variables,
+    no_replace=None,
+    render=render,
+    hardlink=False,
+    durable=False,
+    bytecode_cache=None,
+):
+    """Renders the files under src_dir into the existing directory dst_dir.
 
-    def _should_be_skipped(path):
-        return any(fnmatch.fnmatch(path.name, pattern) for pattern in no_replace)
+    This walks src_dir once, creating each subdirectory in dst_dir and
+    rendering each file directly into its place there. Files and directories
+    matching no_replace are copied (or linked, if hardlink is True) without
+    being rendered. If src_dir and dst_dir are the same, files are rendered in
+    place and those matching no_replace are left alone.
 
-    # we'll do a BFS to find files and explore only directories that should
-    # be explored; we could use os.walk, but this is slightly easier
-    queue = deque([directory])
-    while queue:
-        current_directory = queue.popleft()
+    """
+    skipped_names = _skip_filter(no_replace)
+    render, thread_safe = _prepare_render(
+        render, variables, durable=durable, bytecode_cache=bytecode_cache
+    )
+    # on Linux, shutil's copies already go through os.sendfile (Python 3.8+),
+    # so file contents never pass through user space, and copy2 keeps the
+    # permission bits
+    copy_function = _link_or_copy if hardlink else shutil.copy2
+
+    src_dir, dst_dir = os.fspath(src_dir), os.fspath(dst_dir)
+    in_place = src_dir == dst_dir
+
+    # visiting entries in inode order cuts down on seeking on rotational disks
+    # and some network filesystems; the inode comes with the directory entry
+    sort_by_inode = os.environ.get("INSTANTIATE_SORT_INODE") == "1"
+
+    # a custom render is called on this thread, one file at a time, since it
+    # may not be thread safe
+    pool = _render_pool() if thread_safe else None
+    futures = []
+
+    # like copytree, give each new directory the permissions and times of its
+    # template; this is done once its files are written, so read-only
+    # directories can still be filled and their times aren't disturbed
+    created_directories = [] if in_place else [(src_dir, dst_dir)]
+
+    def _walk(src_dir, dst_dir):
+        with os.scandir(src_dir) as it:
+            entries = list(it)
+        if sort_by_inode:
+            entries.sort(key=lambda entry: entry.inode())
+        skipped = skipped_names([entry.name for entry in entries])
+
+        for entry in entries:
+            dst = os.path.join(dst_dir, entry.name)
+            if entry.name in skipped:
+                if in_place:
+                    continue
+                if entry.is_dir():
+                    shutil.copytree(entry.path, dst, copy_function=copy_function)
+                else:
+                    copy_function(entry.path, dst)
+            # symlinks are followed, both when copying (as copytree does) and
+            # in place
+            elif entry.is_dir():
+                if not in_place:
+                    os.mkdir(dst)
+                    created_directories.append((entry.path, dst))
+                _walk(entry.path, dst)
+            elif entry.is_file():
+                if pool is None:
+                    render(entry.path, dst)
+                else:
+                    futures.append(pool.submit(render, entry.path, dst))
+            # anything else, such as a dangling symlink or a FIFO, is left alone
+            # in place; when copying, it is an error, as it was with copytree
+            elif not in_place:
+                copy_function(entry.path, dst)
+
+    try:
+        _walk(src_dir, dst_dir)
+
+        # re-raise the first error, if any
+        for future in futures:
+            future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
 
-        for subpath in current_directory.iterdir():
-            if _should_be_skipped(subpath):
-                continue
-            if subpath.is_file():
-                render(src=subpath, dst=subpath, variables=variables)
-            elif subpath.is_dir():
-                queue.append(subpath)
+    # deepest first, so setting a directory's times isn't undone by its
+    # subdirectories
+    for src, dst in reversed(created_directories):
+        shutil.copystat(src, dst)
 
 
 def make_project(
@@ -115,6 +435,9 @@ def make_project(
     numbering=None,
     no_replace=None,
     render=render,
+    hardlink=False,
+    durable=False,
+    bytecode_cache=None,
 ):
     """Create a project from the given template.
 
@@ -136,6 +459,20 @@ def make_project(
         A collection of fnmatch-style patterns of filenames on which
         replacement should not be performed. If None, replacement will be 
         performed on all files.
+    render : Callable
+        The function used to render each file. See :func:`replace`.
+    hardlink : bool
+        Whether to hard link the files matching ``no_replace`` into the
+        project instead of copying them, when both are on the same
+        filesystem. Linked files share their contents with the template, so
+        modifying them in place modifies the template too.
+    durable : bool
+        Whether to flush each rendered file to disk before moving it into
+        place. See :func:`replace`.
+    bytecode_cache : jinja2.BytecodeCache
+        Where to keep compiled templates so that later runs can skip compiling
+        them. If None, templates are compiled anew in every process. Only
+        applies to the default ``render``.
 
     Raises
     ------
@@ -165,14 +502,21 @@ def make_project(
     else:
         dst_dir = cwd / project_name
 
-    shutil.copytree(template_dir, dst_dir)
-
-    # replace
     variables = {
         "context": context,
         "project": {"number": project_number, "name": project_name},
     }
-    replace(dst_dir, variables, no_replace=no_replace, render=render)
+    os.mkdir(dst_dir)
+    _copy_and_render(
+        template_dir,
+        dst_dir,
+        variables,
+        no_replace=no_replace,
+        render=render,
+        hardlink=hardlink,
+        durable=durable,
+        bytecode_cache=bytecode_cache,
+    )
 
 
 def cli(argv=None, cwd=None):
@@ -198,12 +542,21 @@ def cli(argv=None, cwd=None):
     parser.add_argument("--numbering", type=int)
     parser.add_argument("--context", type=pathlib.Path)
     parser.add_argument("--no-replace", nargs="+")
+    parser.add_argument("--hardlink", action="store_true")
+    parser.add_argument("--durable", action="store_true")
     args = parser.parse_args(argv)
 
+    # the same templates tend to be instantiated again and again, so keep their
+    # compiled code around between runs
+    try:
+        bytecode_cache = _bytecode_cache(_default_cache_dir())
+    except OSError:
+        bytecode_cache = None
+
     context = {}
     if args.context is not None:
         with args.context.open() as fileobj:
-            context[args.context.stem] = yaml.load(fileobj, Loader=yaml.Loader)
+            context[args.context.stem] = yaml.load(fileobj, Loader=_YAMLLoader)
 
     try:
         make_project(
@@ -213,6 +566,9 @@ def cli(argv=None, cwd=None):
             numbering=args.numbering,
             context=context,
             no_replace=args.no_replace,
+            hardlink=args.hardlink,
+            durable=args.durable,
+            bytecode_cache=bytecode_cache,
         )
     except FileExistsError:
         print("Destination already exists. Not overwriting!")
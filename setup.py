@@ -5,6 +5,8 @@ setup(
     name="instantiate",
     version="0.1.3",
     py_modules=["instantiate"],
+    # context files load faster when pyyaml is built against libyaml, in
+    # which case its C loader is used automatically
     install_requires=["jinja2", "pyyaml"],
     entry_points={"console_scripts": ["instantiate = instantiate:cli"]},
 )
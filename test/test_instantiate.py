@@ -1,5 +1,7 @@
+import concurrent.futures
 import pathlib
 import os
+import threading
 import yaml
 from unittest.mock import Mock
 
@@ -17,6 +19,14 @@ def tempdir(tmpdir):
     return pathlib.Path(tmpdir)
 
 
+@fixture(autouse=True)
+def cache_home(tmpdir_factory, monkeypatch):
+    # keep the bytecode cache enabled by the cli out of the user's home
+    path = pathlib.Path(tmpdir_factory.mktemp("cache"))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(path))
+    return path
+
+
 def test_copy(tempdir):
     # when
     instantiate.cli([str(TEMPLATE_1_PATH), "foo"], cwd=tempdir)
@@ -39,6 +49,187 @@ def test_replacements(tempdir):
     assert contents.strip() == "foo and None"
 
 
+def test_files_without_template_syntax_are_untouched(tempdir):
+    # given
+    with (tempdir / "plain").open("w") as fileobj:
+        fileobj.write("no substitutions here\n")
+
+    # when
+    instantiate.replace(tempdir, {})
+
+    # then
+    with (tempdir / "plain").open() as fileobj:
+        contents = fileobj.read()
+
+    assert contents == "no substitutions here\n"
+
+
+def test_failed_render_leaves_file_untouched(tempdir):
+    # given
+    with (tempdir / "broken").open("w") as fileobj:
+        fileobj.write("{{ not_defined }}")
+
+    # when
+    with raises(RuntimeError):
+        instantiate.replace(tempdir, {})
+
+    # then
+    assert [p.name for p in tempdir.iterdir()] == ["broken"]
+    with (tempdir / "broken").open() as fileobj:
+        assert fileobj.read() == "{{ not_defined }}"
+
+
+def test_replace_renders_through_symlinked_files(tempdir):
+    # given
+    with (tempdir / "target").open("w") as fileobj:
+        fileobj.write("{{ project.name }}")
+    directory = tempdir / "directory"
+    directory.mkdir()
+    (directory / "link").symlink_to(tempdir / "target")
+
+    # when
+    instantiate.replace(directory, {"project": {"name": "foo"}})
+
+    # then
+    assert (directory / "link").is_symlink()
+    with (tempdir / "target").open() as fileobj:
+        assert fileobj.read() == "foo"
+
+
+def test_replace_follows_symlinked_directories_and_skips_dangling_links(tempdir):
+    # given
+    target = tempdir / "target"
+    target.mkdir()
+    with (target / "inside").open("w") as fileobj:
+        fileobj.write("{{ project.name }}")
+    directory = tempdir / "directory"
+    directory.mkdir()
+    (directory / "linkdir").symlink_to(target, target_is_directory=True)
+    (directory / "dangling").symlink_to(tempdir / "does-not-exist")
+
+    # when
+    instantiate.replace(directory, {"project": {"name": "foo"}})
+
+    # then
+    with (target / "inside").open() as fileobj:
+        assert fileobj.read() == "foo"
+    assert (directory / "dangling").is_symlink()
+
+
+def test_render_errors_are_reraised_and_pool_is_shut_down(tempdir, monkeypatch):
+    # given
+    for i in range(8):
+        with (tempdir / f"broken-{i}").open("w") as fileobj:
+            fileobj.write("{{ not_defined }}")
+
+    pools = []
+
+    class RecordingPool(concurrent.futures.ThreadPoolExecutor):
+        def shutdown(self, *args, **kwargs):
+            self.was_shut_down = True
+            super().shutdown(*args, **kwargs)
+
+    def make_pool():
+        pools.append(RecordingPool(max_workers=4))
+        return pools[-1]
+
+    monkeypatch.setattr(instantiate, "_render_pool", make_pool)
+
+    # when
+    with raises(RuntimeError):
+        instantiate.replace(tempdir, {})
+
+    # then
+    assert len(pools) == 1
+    assert pools[0].was_shut_down
+
+
+def test_custom_render_is_called_on_the_calling_thread(tempdir):
+    # given
+    threads = set()
+
+    def render(src, dst, variables):
+        threads.add(threading.current_thread())
+
+    # when
+    instantiate.make_project(tempdir, TEMPLATE_1_PATH, "foo", render=render)
+
+    # then
+    assert threads == {threading.current_thread()}
+
+
+def test_identical_templates_are_rendered_once(tempdir):
+    # given
+    template = tempdir / "template"
+    (template / "subdir").mkdir(parents=True)
+    for path in [template / "a", template / "subdir" / "b"]:
+        with path.open("w") as fileobj:
+            fileobj.write("{{ project.name }}")
+
+    instantiate._compile.cache_clear()
+
+    # when
+    instantiate.make_project(tempdir, template, "foo")
+
+    # then the template was compiled, and so rendered, only once
+    info = instantiate._compile.cache_info()
+    assert (info.misses, info.hits) == (1, 0)
+    for path in [tempdir / "foo" / "a", tempdir / "foo" / "subdir" / "b"]:
+        with path.open() as fileobj:
+            assert fileobj.read() == "foo"
+
+
+def test_duplicates_do_not_wait_forever_on_a_failed_first_render(
+    tempdir, monkeypatch
+):
+    # given
+    for name in ["a", "b"]:
+        with (tempdir / name).open("w") as fileobj:
+            fileobj.write("{{ project.name }}")
+
+    calls = []
+    mkstemp = instantiate.tempfile.mkstemp
+
+    def failing_once_mkstemp(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == 1:
+            raise OSError("no space left on device")
+        return mkstemp(*args, **kwargs)
+
+    monkeypatch.setattr(instantiate.tempfile, "mkstemp", failing_once_mkstemp)
+
+    # when
+    errors = []
+
+    def run():
+        try:
+            instantiate.replace(tempdir, {"project": {"name": "foo"}})
+        except OSError as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+
+    # then
+    assert not thread.is_alive()
+    assert len(errors) == 1
+
+
+def test_duplicates_are_byte_for_byte_identical(tempdir):
+    # given
+    for name in ["a", "b"]:
+        with (tempdir / name).open("w") as fileobj:
+            fileobj.write("{{ context.v }}")
+
+    # when
+    instantiate.replace(tempdir, {"context": {"v": "x\r\ny\rz"}})
+
+    # then
+    assert (tempdir / "a").read_bytes() == b"x\r\ny\rz"
+    assert (tempdir / "b").read_bytes() == b"x\r\ny\rz"
+
+
 def test_replacements_ignore_patterns(tempdir):
     # when
     mock_render = Mock()
@@ -48,9 +239,62 @@ def test_replacements_ignore_patterns(tempdir):
 
     # then
     sources = [x[1]["src"] for x in mock_render.call_args_list]
-    assert not (tempdir / "foo" / "bin" / "bar") in sources
-    assert not (tempdir / "foo" / "subdir" / "a.pdf") in sources
-    assert (tempdir / "foo" / "subdir" / "c.tex") in sources
+    assert not (TEMPLATE_1_PATH / "bin" / "bar") in sources
+    assert not (TEMPLATE_1_PATH / "subdir" / "a.pdf") in sources
+    assert (TEMPLATE_1_PATH / "subdir" / "c.tex") in sources
+    assert (tempdir / "foo" / "subdir" / "a.pdf").exists()
+
+
+def test_hardlink_only_links_files_that_are_not_rendered(tempdir):
+    # given
+    template = tempdir / "template"
+    template.mkdir()
+    with (template / "rendered").open("w") as fileobj:
+        fileobj.write("{{ project.name }}")
+    with (template / "plain").open("w") as fileobj:
+        fileobj.write("plain")
+
+    # when
+    instantiate.make_project(
+        tempdir, template, "foo", no_replace=["plain"], hardlink=True
+    )
+
+    # then
+    with (template / "rendered").open() as fileobj:
+        assert fileobj.read() == "{{ project.name }}"
+    with (tempdir / "foo" / "rendered").open() as fileobj:
+        assert fileobj.read() == "foo"
+    assert (tempdir / "foo" / "plain").samefile(template / "plain")
+
+
+def test_directory_permissions_are_copied_from_the_template(tempdir):
+    # given
+    template = tempdir / "template"
+    (template / "private").mkdir(parents=True)
+    with (template / "private" / "secret").open("w") as fileobj:
+        fileobj.write("{{ project.name }}")
+    (template / "private").chmod(0o700)
+    template.chmod(0o750)
+
+    # when
+    instantiate.make_project(tempdir, template, "foo")
+
+    # then
+    assert (tempdir / "foo").stat().st_mode & 0o777 == 0o750
+    assert (tempdir / "foo" / "private").stat().st_mode & 0o777 == 0o700
+    with (tempdir / "foo" / "private" / "secret").open() as fileobj:
+        assert fileobj.read() == "foo"
+
+
+def test_dangling_symlink_in_template_is_an_error(tempdir):
+    # given
+    template = tempdir / "template"
+    template.mkdir()
+    (template / "dangling").symlink_to(tempdir / "does-not-exist")
+
+    # when / then
+    with raises(OSError):
+        instantiate.make_project(tempdir, template, "foo")
 
 
 def test_additional_context(tempdir):
@@ -76,6 +320,34 @@ def test_additional_context(tempdir):
     )
 
 
+def test_cli_caches_compiled_templates(tempdir, cache_home, monkeypatch):
+    # when
+    instantiate.cli([str(TEMPLATE_1_PATH), "foo"], cwd=tempdir)
+
+    # the second run must load every template from the on-disk cache
+    instantiate._compile.cache_clear()
+    monkeypatch.setattr(
+        instantiate._ENVIRONMENT, "compile", Mock(side_effect=AssertionError)
+    )
+    instantiate.cli([str(TEMPLATE_1_PATH), "bar"], cwd=tempdir)
+
+    # then
+    with (tempdir / "bar" / "one").open() as fileobj:
+        assert fileobj.read().strip() == "bar and None"
+
+
+def test_library_calls_do_not_use_the_bytecode_cache(tempdir, cache_home):
+    # when
+    instantiate.cli([str(TEMPLATE_1_PATH), "foo"], cwd=tempdir)
+    for path in (cache_home / "instantiate").iterdir():
+        path.unlink()
+    instantiate._compile.cache_clear()
+    instantiate.make_project(tempdir, TEMPLATE_1_PATH, "bar")
+
+    # then
+    assert not list((cache_home / "instantiate").iterdir())
+
+
 def test_numbering(tempdir):
     # when
     instantiate.cli([str(TEMPLATE_1_PATH), "foo", "--numbering", "3"], cwd=tempdir)
@@ -84,6 +356,20 @@ def test_numbering(tempdir):
     assert (tempdir / "001-foo").is_dir()
 
 
+def test_numbering_continues_from_existing_projects(tempdir):
+    # given
+    (tempdir / "001-foo").mkdir()
+    (tempdir / "003-bar").mkdir()
+    (tempdir / "12-short").mkdir()
+    (tempdir / "009-not-a-directory").touch()
+
+    # when
+    instantiate.cli([str(TEMPLATE_1_PATH), "baz", "--numbering", "3"], cwd=tempdir)
+
+    # then
+    assert (tempdir / "004-baz").is_dir()
+
+
 def test_no_numbering(tempdir):
     # when
     instantiate.cli([str(TEMPLATE_1_PATH), "foo"], cwd=tempdir)